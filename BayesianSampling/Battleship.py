@@ -1,11 +1,343 @@
 import numpy as np
-import random
 from itertools import permutations
-from collections import Counter
 import string
+import inspect
+import importlib.util
+import os
+import sys
+import tempfile
 from time import time
 from matplotlib import pyplot as plt
 from tqdm import tqdm
+from numba import njit, prange, get_num_threads
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+@njit(cache=True, boundscheck=False)
+def _popcount(x):
+    """
+    Number of set bits in a single uint64 word (branchless SWAR, lowered to POPCNT by LLVM)
+    """
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return np.int64((x * _H01) >> np.uint64(56))
+
+@njit(cache=True, boundscheck=False)
+def _bitIndex(x):
+    """
+    Index of the lowest set bit of a non-zero uint64 word
+    """
+    return _popcount((x & (~x + np.uint64(1))) - np.uint64(1))
+
+@njit(cache=True, boundscheck=False)
+def _pickOrientation(shipMasks, orientBitmap, orientAlive, ship, blocked, needed, minNeeded, candidates):
+    """
+    Uniformly pick an orientation of `ship` that is disjoint from `blocked` and covers more than
+    `minNeeded` cells of `needed` (pass minNeeded = -1 to skip the coverage test).
+      - start from the bitmap of the ship's alive orientations and clear the orientations touching
+        each blocked cell (orientBitmap[ship, cell]), so only the occupied cells are visited
+      - then draw a random set bit of what is left (`candidates` is scratch space for the bitmap)
+    Returns -1 if there is no such orientation.
+    """
+    orientWords = candidates.shape[0]
+    for v in range(orientWords):
+        candidates[v] = orientAlive[ship, v]
+    for w in range(blocked.shape[0]):
+        x = blocked[w]
+        while x:
+            cell = w * 64 + _bitIndex(x)
+            for v in range(orientWords):
+                candidates[v] &= ~orientBitmap[ship, cell, v]
+            x &= x - np.uint64(1)
+    
+    num = 0
+    for v in range(orientWords):
+        if minNeeded >= 0:
+            x = candidates[v]
+            while x:
+                o = v * 64 + _bitIndex(x)
+                covered = 0
+                for w in range(needed.shape[0]):
+                    covered += _popcount(shipMasks[ship, o, w] & needed[w])
+                if covered <= minNeeded:
+                    candidates[v] &= ~(x & (~x + np.uint64(1)))
+                x &= x - np.uint64(1)
+        num += _popcount(candidates[v])
+    if num == 0:
+        return -1
+    
+    target = np.random.randint(num)
+    for v in range(orientWords):
+        n = _popcount(candidates[v])
+        if target < n:
+            x = candidates[v]
+            for _ in range(target):
+                x &= x - np.uint64(1)
+            return v * 64 + _bitIndex(x)
+        target -= n
+    return -1
+
+@njit(cache=True, boundscheck=False)
+def _covers(final, hits):
+    """
+    Check whether every hit is accounted for by the board
+    """
+    missing = np.uint64(0)
+    for w in range(hits.shape[0]):
+        missing |= hits[w] & ~final[w]
+    return missing == 0
+
+@njit(cache=True, boundscheck=False)
+def _randomSelection(shipMasks, orientBitmap, orientAlive, shipLengths, order, mustHappen, hits, final, whatWhere):
+    """
+    Select a random board, conditioned on the the current misses, hits, and sinks (see 
+    BattleshipPlayer.randomConditionalBoards), writing it into `final`.
+    Returns False if a ship ran out of legal moves and the selection has to be restarted.
+    """
+    numWords = mustHappen.shape[0]
+    numShips = order.shape[0]
+    blocked = np.empty(numWords, dtype=np.uint64)
+    needed = np.empty(numWords, dtype=np.uint64)
+    candidates = np.empty(orientAlive.shape[1], dtype=np.uint64)
+    while 1:
+        final[:] = mustHappen
+        for i in range(numShips):
+            ship = order[i]
+            o = _pickOrientation(shipMasks, orientBitmap, orientAlive, ship, final, needed, -1, candidates)
+            if o < 0:
+                return False
+            whatWhere[i] = shipMasks[ship, o]
+            final |= whatWhere[i]
+        if _covers(final, hits):
+            return True
+
+        for count in range(3):
+            for i in range(numShips):
+                ship = order[i]
+                already = 0
+                for w in range(numWords):
+                    needed[w] = hits[w] & ~final[w]
+                    already += _popcount(whatWhere[i, w] & hits[w])
+                if already < shipLengths[ship]:
+                    # ships never overlap, so removing this ship from the board leaves the others
+                    for w in range(numWords):
+                        blocked[w] = final[w] & ~whatWhere[i, w]
+                    o = _pickOrientation(shipMasks, orientBitmap, orientAlive, ship, blocked, needed, already, candidates)
+                    if o < 0:
+                        continue
+                    for w in range(numWords):
+                        whatWhere[i, w] = shipMasks[ship, o, w]
+                        final[w] = blocked[w] | whatWhere[i, w]
+                    if _covers(final, hits):
+                        return True
+
+        np.random.shuffle(order)
+
+@njit(cache=True, boundscheck=False)
+def _accumulate(board, weight, hist):
+    """
+    Add `weight` to hist[bit] for every set bit of the board
+    """
+    for w in range(board.shape[0]):
+        x = board[w]
+        while x:
+            low = x & (~x + np.uint64(1))
+            hist[w * 64 + _popcount(low - np.uint64(1))] += weight
+            x ^= low
+
+@njit(cache=True, boundscheck=False)
+def _aggregateBoards(boards, weights, hist):
+    """
+    Add the weighted cell counts of every board in a (numBoards, numWords) array to hist
+    """
+    for b in range(boards.shape[0]):
+        _accumulate(boards[b], weights[b], hist)
+
+@njit(cache=True, boundscheck=False, parallel=True)
+def _sampleBoards(shipMasks, orientBitmap, orientAlive, shipLengths, order, mustHappen, hits, numBoards, randomOrder, hist, weight, seed, numThreads):
+    """
+    Sample `numBoards` conditional boards, returned as a (numBoards, numWords) uint64 array,
+    and add their cell counts (times `weight`) to hist as they are generated.
+      - the batch is split into one chunk per thread (numThreads), sampled in parallel (prange), each with 
+        private scratch space and histogram row, reduced into hist at the end
+      - chunk c seeds its thread's random stream with seed + c, so all draws follow from 
+        Battleship.rng (for a given number of threads)
+    """
+    numWords = mustHappen.shape[0]
+    boards = np.zeros((numBoards, numWords), dtype=np.uint64)
+    numChunks = max(1, min(numThreads, numBoards))
+    chunk = (numBoards + numChunks - 1) // numChunks
+    hists = np.zeros((numChunks, hist.shape[0]))
+    for c in prange(numChunks):
+        np.random.seed(seed + c)
+        chunkOrder = order.copy()
+        whatWhere = np.zeros((order.shape[0], numWords), dtype=np.uint64)
+        for b in range(c * chunk, min(numBoards, (c + 1) * chunk)):
+            if randomOrder:
+                np.random.shuffle(chunkOrder)
+            current = chunkOrder.copy()
+            while not _randomSelection(shipMasks, orientBitmap, orientAlive, shipLengths, current, mustHappen, hits, boards[b], whatWhere):
+                if randomOrder:
+                    np.random.shuffle(current)
+            _accumulate(boards[b], weight, hists[c])
+    hist += hists.sum(axis=0)
+    return boards
+
+_SAMPLER_TEMPLATE = """
+@njit(cache=True, boundscheck=False)
+def pick(shipMasks, orientBitmap, orientAlive, ship, {blocked}, {needed}, minNeeded):
+    {candidates} = {aliveRow}
+{clearBlocked}
+    if minNeeded >= 0:
+{clearUncovered}
+    {counts} = {popcounts}
+    num = {total}
+    if num == 0:
+        return -1
+    target = np.random.randint(num)
+{selectWord}
+    for _ in range(target):
+        x &= x - ONE
+    return base + _bitIndex(x)
+
+@njit(cache=True, boundscheck=False)
+def select(shipMasks, orientBitmap, orientAlive, shipLengths, order, mustHappen, hits, final, whatWhere):
+    numShips = order.shape[0]
+    {must} = {mustWords}
+    {hits} = {hitsWords}
+    while 1:
+        {final} = {must}
+        for i in range(numShips):
+            ship = order[i]
+            o = pick(shipMasks, orientBitmap, orientAlive, ship, {final}, {zeros}, -1)
+            if o < 0:
+                return False
+            {storeShip}
+            {final} = {finalOrShip}
+        if ({missing}) == 0:
+            {storeFinal}
+            return True
+
+        for count in range(3):
+            for i in range(numShips):
+                ship = order[i]
+                {needed} = {hitsNotFinal}
+                already = {alreadyCount}
+                if already < shipLengths[ship]:
+                    {blocked} = {finalWithoutShip}
+                    o = pick(shipMasks, orientBitmap, orientAlive, ship, {blocked}, {needed}, already)
+                    if o < 0:
+                        continue
+                    {storeShip}
+                    {final} = {blockedOrShip}
+                    if ({missing}) == 0:
+                        {storeFinal}
+                        return True
+
+        np.random.shuffle(order)
+
+_randomSelection = select
+"""
+
+def _specializeSampler(numWords, orientWords):
+    """
+    Generate a drop-in replacement for _sampleBoards with the number of board words and
+    orientation words fixed: _pickOrientation and _randomSelection are rewritten with every loop 
+    over words unrolled and the boards and bitmaps held in scalar locals instead of arrays, and 
+    the source of the _sampleBoards driver is compiled against them.
+      - the source is written to a module file (in __pycache__ next to this file, or the per-user 
+        cache directory if that is not writable) and imported from there, so that cache=True applies 
+        and the compiled sampler is reused across sessions; the file is only (atomically) rewritten 
+        when its content differs from the source, which would invalidate the cache
+    Returns the (lazily compiled) @njit function, or the generic _sampleBoards if neither folder 
+    can be written
+    """
+    def join(template, count, sep=", "):
+        return sep.join(template.format(k=k) for k in range(count))
+    
+    words = lambda prefix: join(prefix + "{k}", numWords)
+    clearBlocked = "\n".join(
+        "    x = blocked{w}\n"
+        "    while x:\n"
+        "        cell = {base} + _bitIndex(x)\n"
+        "        {clear}\n"
+        "        x &= x - ONE".format(w=w, base=64 * w, clear=join("c{k} &= ~orientBitmap[ship, cell, {k}]", orientWords, "; "))
+        for w in range(numWords))
+    clearUncovered = "\n".join(
+        "        x = c{v}\n"
+        "        while x:\n"
+        "            o = {base} + _bitIndex(x)\n"
+        "            if {covered} <= minNeeded:\n"
+        "                c{v} &= ~(x & (~x + ONE))\n"
+        "            x &= x - ONE".format(v=v, base=64 * v, covered=join("_popcount(shipMasks[ship, o, {k}] & needed{k})", numWords, " + "))
+        for v in range(orientWords))
+    selectWord = []
+    for v in range(orientWords):
+        if orientWords == 1:
+            condition, indent = "", "    "
+        elif v == orientWords - 1:
+            condition, indent = "    else:\n", "        "
+        else:
+            condition, indent = "    %s target < %s:\n" % ("if" if v == 0 else "elif", join("p{k}", v + 1, " + ")), "        "
+        selectWord.append(condition + indent + "x = c%d\n" % v + indent + "base = %d\n" % (64 * v) + 
+                          indent + "target -= %s" % (join("p{k}", v, " + ") or "0"))
+    selectWord = "\n".join(selectWord)
+    
+    source = _SAMPLER_TEMPLATE.format(
+        blocked=words("blocked"), needed=words("needed"), must=words("must"), 
+        hits=words("hits"), final=words("final"), zeros=join("ZERO", numWords),
+        candidates=join("c{k}", orientWords), aliveRow=join("orientAlive[ship, {k}]", orientWords),
+        counts=join("p{k}", orientWords), popcounts=join("_popcount(c{k})", orientWords), total=join("p{k}", orientWords, " + "),
+        clearBlocked=clearBlocked, clearUncovered=clearUncovered, selectWord=selectWord,
+        finalOrShip=join("final{k} | shipMasks[ship, o, {k}]", numWords), missing=join("(hits{k} & ~final{k})", numWords, " | "),
+        storeShip=join("whatWhere[i, {k}] = shipMasks[ship, o, {k}]", numWords, "; "),
+        storeFinal=join("final[{k}] = final{k}", numWords, "; "), hitsNotFinal=join("hits{k} & ~final{k}", numWords),
+        alreadyCount=join("_popcount(whatWhere[i, {k}] & hits{k})", numWords, " + "),
+        finalWithoutShip=join("final{k} & ~whatWhere[i, {k}]", numWords),
+        blockedOrShip=join("blocked{k} | shipMasks[ship, o, {k}]", numWords),
+        mustWords=join("mustHappen[{k}]", numWords), hitsWords=join("hits[{k}]", numWords))
+    
+    header = "\n".join(["import numpy as np", "from numba import njit, prange", "",
+                        "ONE = np.uint64(1)", "ZERO = np.uint64(0)"] +
+                       ["%s = np.uint64(%s)" % (name, hex(int(globals()[name]))) for name in ("_M1", "_M2", "_M4", "_H01")] +
+                       [""] + [inspect.getsource(f.py_func) for f in (_popcount, _bitIndex, _accumulate)])
+    source = header + source + "\n" + inspect.getsource(_sampleBoards.py_func)
+    
+    name = "_sampler_w%d_o%d" % (numWords, orientWords)
+    userCache = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")), "Battleship")
+    for folder in (os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__"), userCache):
+        path = os.path.join(folder, name + ".py")
+        try:
+            os.makedirs(folder, mode=0o700, exist_ok=True)
+            try:
+                with open(path) as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = None
+            if current != source:
+                # write a private temporary file and swap it in, so a concurrent import never sees a partial file
+                fd, temporary = tempfile.mkstemp(suffix=".py", dir=folder)
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(source)
+                    os.replace(temporary, path)
+                except OSError:
+                    os.unlink(temporary)
+                    raise
+            break
+        except OSError:
+            continue
+    else:
+        return _sampleBoards # nowhere to keep a module this process wrote or checked: use the generic sampler
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module._sampleBoards
 
 class Battleship:
     """
@@ -16,6 +348,9 @@ class Battleship:
     ships : list , list of ship lengths that fit on the board
     """
     
+    _LAYOUT_CACHE = dict() # layouts and orders only depend on (dim, ships), so they are shared read-only
+    _ORDER_CACHE = dict()  # between instances
+    
     def __init__(self, dim=10, ships=[2,3,3,4,5]):
         self.dim = dim
         self.numShips = len(ships)
@@ -23,6 +358,8 @@ class Battleship:
         self.names = tuple(string.ascii_lowercase[:len(ships)]) # letter names to track in the case of duplicate lengths
         self.sunkDict = dict(zip(self.names,[0 for i in ships])) # keep track of which are fixed in place
         self.shipLengths = dict(zip(self.names,ships)) # put lengths to names
+        self.numWords = (dim * dim + 63) // 64 # number of uint64 words needed to hold one bit per cell
+        self.rng = np.random.default_rng() # single generator for every draw made from Python
         self.generateComponentLayouts() 
         self.generateRandomOrders()
     
@@ -30,40 +367,123 @@ class Battleship:
         """
         Generate dictionary of random orders so they don't have to be made on the fly (it saves slightly more time)
         """
-        perms = list(permutations(self.names))
-        self.numPerms = len(perms)
-        self.randomOrderDict = dict(zip(range(self.numPerms), [list(i) for i in perms]))
+        if self.names not in Battleship._ORDER_CACHE:
+            perms = list(permutations(self.names))
+            Battleship._ORDER_CACHE[self.names] = dict(zip(range(len(perms)), [list(i) for i in perms]))
+        self.randomOrderDict = Battleship._ORDER_CACHE[self.names]
+        self.numPerms = len(self.randomOrderDict)
         
+    def cellsToMask(self, cells):
+        """
+        Convert an iterable of (i,j) cells into a bitmask of `numWords` uint64 words
+        (bit i*dim + j is set for cell (i,j))
+        """
+        mask = np.zeros(self.numWords, dtype=np.uint64)
+        for i, j in cells:
+            bit = i * self.dim + j
+            mask[bit >> 6] |= np.uint64(1) << np.uint64(bit & 63)
+        return mask
+
+    def masksToBits(self, masks):
+        """
+        Convert an array of bitmasks (along the last axis) into boolean vectors of dim*dim cells
+        """
+        bits = np.unpackbits(np.ascontiguousarray(masks).astype('<u8').view(np.uint8), axis=-1, bitorder='little')
+        return bits[..., :self.dim * self.dim].astype(bool)
+
+    def bitsToMasks(self, bits, numWords):
+        """
+        Pack boolean vectors (along the last axis) into bitmasks of `numWords` uint64 words
+        """
+        padded = np.zeros(bits.shape[:-1] + (numWords * 64,), dtype=bool)
+        padded[..., :bits.shape[-1]] = bits
+        return np.packbits(padded, axis=-1, bitorder='little').view('<u8').astype(np.uint64)
+
+    def maskToMatrix(self, mask):
+        """
+        Convert a bitmask into a (dim, dim) boolean matrix
+        """
+        return self.masksToBits(mask).reshape(self.dim, self.dim)
+
+    def maskToCells(self, mask):
+        """
+        Convert a bitmask back into a list of (i,j) cells
+        """
+        return [(int(i), int(j)) for i, j in zip(*np.nonzero(self.maskToMatrix(mask)))]
+
+    def cellInMask(self, cell, mask):
+        """
+        Check whether the (i,j) cell is set in the bitmask
+        """
+        bit = cell[0] * self.dim + cell[1]
+        return bool((mask[bit >> 6] >> np.uint64(bit & 63)) & np.uint64(1))
+
     def generateComponentLayouts(self):
         """
         Load all legal moves for each ship to define possible moves
+          - each orientation is stored as a row of an (orientations, numWords) uint64 bitmask array
+          - all orientations are also stacked in self.orientations, with self.orientShip giving the
+            index of the ship each belongs to and self.orientLocal its index within that ship
+          - self.cellMasks holds the single-cell bitmask of every cell
+          - for the compiled sampler, self.shipMasks holds them padded per ship as a 
+            (numShips, maxOrientations, numWords) array, and self.orientBitmap is the 
+            (numShips, dim*dim, orientWords) bitmap of which orientations of a ship touch a cell
+          - the default game (10x10, ships [2,3,3,4,5]) gets self.sampleBoards generated by 
+            _specializeSampler for its word counts, every other game uses the generic _sampleBoards
+          - the result is cached per (dim, ships) in Battleship._LAYOUT_CACHE
         """
 
+        key = (self.dim, self.ships)
+        if key in Battleship._LAYOUT_CACHE:
+            for attr, value in Battleship._LAYOUT_CACHE[key].items():
+                setattr(self, attr, value)
+            return
+        
         self.possibleShipsDict = dict()
         self.possibleShipsNumDict = dict()
         
         for name in self.names:
-            orientations1 = [{(i+temp,j) for temp in range(self.shipLengths[name])} for i in range(self.dim - self.shipLengths[name] + 1) for j in range(self.dim)]
-            orientations2 = [{(j,i+temp) for temp in range(self.shipLengths[name])} for i in range(self.dim - self.shipLengths[name] + 1) for j in range(self.dim)]
-            self.possibleShipsDict[name] = orientations1 + orientations2
+            orientations1 = [self.cellsToMask((i+temp,j) for temp in range(self.shipLengths[name])) for i in range(self.dim - self.shipLengths[name] + 1) for j in range(self.dim)]
+            orientations2 = [self.cellsToMask((j,i+temp) for temp in range(self.shipLengths[name])) for i in range(self.dim - self.shipLengths[name] + 1) for j in range(self.dim)]
+            self.possibleShipsDict[name] = np.array(orientations1 + orientations2, dtype=np.uint64)
             self.possibleShipsNumDict[name] = len(orientations1) + len(orientations2)
+            
+        self.orientations = np.concatenate([self.possibleShipsDict[name] for name in self.names])
+        self.orientShip = np.repeat(np.arange(self.numShips), [self.possibleShipsNumDict[name] for name in self.names])
+        self.orientLocal = np.concatenate([np.arange(self.possibleShipsNumDict[name]) for name in self.names])
+        self.cellMasks = self.bitsToMasks(np.eye(self.dim * self.dim, dtype=bool), self.numWords)
+        
+        maxOrient = max(self.possibleShipsNumDict.values())
+        self.orientWords = (maxOrient + 63) // 64
+        self.shipMasks = np.zeros((self.numShips, maxOrient, self.numWords), dtype=np.uint64)
+        self.shipMasks[self.orientShip, self.orientLocal] = self.orientations
+        self.orientBitmap = self.bitsToMasks(self.masksToBits(self.shipMasks).transpose(0, 2, 1), self.orientWords)
+        self.sampleBoards = _specializeSampler(self.numWords, self.orientWords) if key == (10, (2, 3, 3, 4, 5)) else _sampleBoards
+        
+        layout = dict(possibleShipsDict=self.possibleShipsDict, possibleShipsNumDict=self.possibleShipsNumDict, 
+                      orientations=self.orientations, orientShip=self.orientShip, orientLocal=self.orientLocal, 
+                      cellMasks=self.cellMasks, orientWords=self.orientWords, shipMasks=self.shipMasks, 
+                      orientBitmap=self.orientBitmap, sampleBoards=self.sampleBoards)
+        for array in list(self.possibleShipsDict.values()) + [self.orientations, self.orientShip, self.orientLocal, 
+                                                              self.cellMasks, self.shipMasks, self.orientBitmap]:
+            array.flags.writeable = False
+        Battleship._LAYOUT_CACHE[key] = layout
         
     def randomBoard(self):
         """
         Build completely random board picking and placing ships in a random order 
         """
-        order = self.randomOrderDict[np.random.randint(0, self.numPerms)]
-        final_set, self.boats = set(), []
+        order = self.randomOrderDict[self.rng.integers(self.numPerms)]
+        final_mask, self.boats = np.zeros(self.numWords, dtype=np.uint64), []
         
         for name in order:
-            while 1:
-                ship_coords = self.possibleShipsDict[name][np.random.randint(self.possibleShipsNumDict[name])]
-                if ship_coords.isdisjoint(final_set):
-                    final_set.update(ship_coords)
-                    self.boats.append((name, ship_coords))
-                    break
+            masks = self.possibleShipsDict[name]
+            alternatives = masks[~(masks & final_mask).any(axis=1)]
+            ship_mask = alternatives[self.rng.integers(len(alternatives))]
+            final_mask |= ship_mask
+            self.boats.append((name, ship_mask))
         self.boats = tuple(self.boats)
-        return final_set
+        return final_mask
                 
 class BattleshipPlayer(Battleship):
     """
@@ -81,10 +501,12 @@ class BattleshipPlayer(Battleship):
     def __init__(self, dim=10, ships=[2,3,3,4,5], randomOrder=True, batchSize=1000, printTime=False):
         super().__init__(dim, ships)
         self.board = self.randomBoard()
-        self.hits, self.hitsSunk, self.misses = set(), set(), set()
-        self.possibleShipsDictCond = self.possibleShipsDict.copy()
+        self.hits, self.misses = set(), set()
+        self.hitsSunk = np.zeros(self.numWords, dtype=np.uint64)
+        self.aliveOrient = np.ones(len(self.orientations), dtype=bool)
         self.possibleShipsNumDictCond = self.possibleShipsNumDict.copy()
-        self.lastTurnBoards = list()
+        self.particles = np.zeros((0, self.numWords), dtype=np.uint64)
+        self.weights = np.zeros(0)
         self.nextInx = (-1,-1)
         self.randomOrder = randomOrder
         self.batchSize = batchSize
@@ -100,40 +522,58 @@ class BattleshipPlayer(Battleship):
           - removes locations that have misses
           - when a boat is sunk, its location is fixed and other boats cannot overlap with the sunken hit
           - Finds places where only a single boat can be, and limits a boat's choices to that subset
+            (all hits at once, repeated until no more choices are removed)
 
         """  
         
+        self.hitsMask = self.cellsToMask(self.hits)
+        self.missesMask = self.cellsToMask(self.misses)
         for i in self.boats:
             boat, location = i
-            if location.issubset(self.hits):
-                self.hitsSunk.update(location)
+            if not (location & ~self.hitsMask).any():
+                self.hitsSunk |= location
                 self.sunkDict[boat] = 1
-                self.possibleShipsDictCond[boat] = list(location)
-                self.possibleShipsNumDictCond[boat] = 1
-        sunkNum = len(self.hitsSunk)
+                self.aliveOrient &= (self.orientShip != self.names.index(boat)) | (self.orientations == location).all(axis=1)
         
-        for name in self.names:
-            if 1 - self.sunkDict[name]:
-                new_orient = [config for config in self.possibleShipsDictCond[name] if self.misses.isdisjoint(config) and config.isdisjoint(self.hitsSunk)]
-                self.possibleShipsDictCond[name] = new_orient
-                self.possibleShipsNumDictCond[name] = len(new_orient)
+        blocked = self.missesMask | self.hitsSunk
+        sunk = np.array([self.sunkDict[name] for name in self.names], dtype=bool)
+        self.aliveOrient &= sunk[self.orientShip] | ~(self.orientations & blocked).any(axis=1)
                 
-        for hit in self.hits:
-            temp = []
-            for i in self.possibleShipsDictCond.items():
-                name, locations = i
-                if hit in set().union(*locations):
-                    temp.append(name)
-            if len(temp) == 1:
-                self.possibleShipsDictCond[temp[0]] = [k for k in self.possibleShipsDictCond[temp[0]] if hit in k]
-                self.possibleShipsNumDictCond[temp[0]] = len(self.possibleShipsDictCond[temp[0]])
+        hitCells = np.array([i * self.dim + j for i, j in self.hits], dtype=np.int64)
+        while len(hitCells):
+            # every ship keeps at least its true location, so no reduceat segment is empty
+            alive = np.flatnonzero(self.aliveOrient)
+            shipCover = np.bitwise_or.reduceat(self.orientations[alive], np.searchsorted(self.orientShip[alive], np.arange(self.numShips)), axis=0)
+            coveredBy = self.masksToBits(shipCover)[:, hitCells].T # (hits, ships) which ships can still cover each hit
+            single = coveredBy.sum(axis=1) == 1
+            required = np.zeros((self.numShips, self.numWords), dtype=np.uint64)
+            np.bitwise_or.at(required, coveredBy[single].argmax(axis=1), self.cellMasks[hitCells[single]])
+            missed = (required[self.orientShip] & ~self.orientations).any(axis=1) & self.aliveOrient
+            if not missed.any():
+                break
+            self.aliveOrient &= ~missed
+                
+        counts = np.bincount(self.orientShip[self.aliveOrient], minlength=self.numShips)
+        for name, count in zip(self.names, counts):
+            self.possibleShipsNumDictCond[name] = int(count)
                 
                 
         self.order = [k for k, _ in sorted(self.possibleShipsNumDictCond.items(), key=lambda item: item[1])]
                 
-    def randomSelection(self, order, mustHappen):
+    def packOrientations(self):
+        """
+        Pack the alive orientations into a (numShips, orientWords) bitmap (bit o of row k is set if 
+        orientation o of ship k in self.shipMasks is still legal) for the compiled sampler
         """
-        Select a random board, conditioned on the the current misses, hits, and sinks
+        alive = np.zeros(self.shipMasks.shape[:2], dtype=bool)
+        alive[self.orientShip, self.orientLocal] = self.aliveOrient
+        self.orientAlive = self.bitsToMasks(alive, self.orientWords)
+
+    def randomConditionalBoards(self, orderIncoming, numBoards, hist, weight):
+        """
+        Sample `numBoards` boards conditioned on the the current misses, hits, and sinks, 
+        adding their cell counts times `weight` to `hist` (a flat array of dim*dim cells)
+          - remove non-choices (sunk ships are fixed in place)
           - Initially, naively finds a legal board and checks if all the hits are accounted for
           - If that fails, we iterate through each of the ships 3 times and check if there are 
             changes that could have been made to increase our hit coverage.
@@ -143,98 +583,74 @@ class BattleshipPlayer(Battleship):
             probability of there being possible boards. 
         """
 
-        what_where = dict()
-        while 1:
-            final_set = mustHappen
-            for i in order:
-                alternatives = [k for k in self.possibleShipsDictCond[i] if k.isdisjoint(final_set)]
-                if alternatives == []:
-                    return set()
-                ship_coords = np.random.choice(alternatives)
-                what_where[i] = ship_coords
-                final_set = final_set.union(ship_coords)
-            if self.hits.issubset(final_set):
-                return list(final_set)
-
-            count = 0
-            what_where["other"] = mustHappen
-            while count < 3:
-                count += 1
-                for entry in what_where.items():
-                    needed = self.hits.difference(final_set)
-                    num_intersected_already = len(entry[1].intersection(self.hits))
-                    if  entry[0] != "other" and num_intersected_already < self.shipLengths[entry[0]]:                    
-                        temp = set().union(*[k[1] for k in what_where.items() if k[0] != entry[0]])
-                        alternatives = [k for k in self.possibleShipsDictCond[entry[0]] if k.isdisjoint(temp) and len(needed.intersection(k)) > num_intersected_already]
-                        if alternatives == []:
-                            continue
-                        what_where[entry[0]] = np.random.choice(alternatives)
-                        final_set = set().union(*[k[1] for k in what_where.items()])
-                        if self.hits.issubset(final_set):
-                            return list(final_set)
-
-            random.shuffle(order)
-            
-            
-    def randomConditionalBoard(self, orderIncoming):
+        mustHappen = np.zeros(self.numWords, dtype=np.uint64)
+        for boat, location in self.boats:
+            if self.sunkDict[boat]:
+                mustHappen |= location
+        index = dict(zip(self.names, range(self.numShips)))
+        order = np.array([index[name] for name in orderIncoming if not self.sunkDict[name]], dtype=np.int64)
+        shipLengths = np.array(self.ships, dtype=np.int64)
+        
+        return self.sampleBoards(self.shipMasks, self.orientBitmap, self.orientAlive, shipLengths, order, mustHappen, self.hitsMask, numBoards, self.randomOrder, hist, weight, self.rng.integers(2**31), get_num_threads())
+    
+    def reweightParticles(self):
         """
-        Initialize the order:
-          - remove non-choices
-          - shuffle boards between tries if necessary
+        Reweight the particles (boards kept from previous turns) by every shot so far:
+        boards that cover a miss or leave a hit uncovered are given zero weight
+        (so several guesses between two calls to buildAggBoard are all accounted for)
         """
+        contradicted = (self.particles & self.missesMask).any(axis=1) | (self.hitsMask & ~self.particles).any(axis=1)
+        self.weights[contradicted] = 0
 
-        order = orderIncoming.copy()
-        mustHappen = set()
-        for i in self.sunkDict.items():
-            if i[1]:
-                order.remove(i[0])
-                mustHappen.update(dict(self.boats)[i[0]]) 
-        
-        final_set = set()
-        while len(final_set) == 0:
-            final_set = self.randomSelection(order, mustHappen)
-            if self.randomOrder:
-                random.shuffle(order)
-
-        return final_set
+    def resampleParticles(self, order, hist):
+        """
+        Resample the particles once the effective sample size drops below half the batch size
+          - keep round(ESS) of the current particles by systematic resampling on their weights
+          - refill the rest of the batch with fresh boards from randomConditionalBoards
+          - reset the weights to uniform
+        Returns False (leaving hist untouched) if no resampling was needed
+        """
+        total = self.weights.sum()
+        ess = total ** 2 / (self.weights ** 2).sum() if total > 0 else 0
+        if ess >= self.batchSize / 2:
+            return False
+        numKeep = int(round(ess)) # S equal weights can give an ESS just under S
+        weight = 1 / self.batchSize
+        if numKeep:
+            positions = (np.arange(numKeep) + self.rng.random()) / numKeep
+            index = np.searchsorted(np.cumsum(self.weights / total), positions)
+            kept = self.particles[np.minimum(index, len(self.particles) - 1)]
+        else:
+            kept = np.zeros((0, self.numWords), dtype=np.uint64)
+        _aggregateBoards(kept, np.full(numKeep, weight), hist)
+        fresh = self.randomConditionalBoards(order, self.batchSize - numKeep, hist, weight)
+        self.particles = np.concatenate([kept, fresh])
+        self.weights = np.full(self.batchSize, weight)
+        return True
 
-            
-    
     def buildAggBoard(self):
         """
-        Main function to build boards and gereate probabilites
-          - recall all the boards generrated last turn which are still valid (major time saver)
-          - get the rest of the necessary boards from randomConditionalBoard
-          - order the collection of possible hits to get the maximal value
+        Main function to build boards and gereate probabilites (Sequential Monte Carlo)
+          - reweight the particles generated on previous turns by every hit and miss (major time saver)
+          - resample and refill them from randomConditionalBoards when too few remain
+          - sum the weighted boards into the probability of a hit on each cell, self.aggMatrix
 
         """
 
 
         t = time()
-        order = [k for k, v in sorted(self.possibleShipsNumDictCond.items(), key=lambda item: item[1])] if not self.randomOrder else self.randomOrderDict[np.random.randint(0, self.numPerms)]
+        order = [k for k, v in sorted(self.possibleShipsNumDictCond.items(), key=lambda item: item[1])] if not self.randomOrder else self.randomOrderDict[self.rng.integers(self.numPerms)]
         self.updateOrientations()
-        lboards, boards = [], []
+        self.packOrientations()
+        self.reweightParticles()
         
-        if self.nextInx in self.hits:
-            lboards = [i for i in self.lastTurnBoards if self.nextInx in i]
-            boards = [j for i in lboards for j in list(i) if self.nextInx in i]
-            
-        if self.nextInx in self.misses:
-            lboards = [i for i in self.lastTurnBoards if self.nextInx not in i]
-            boards = [j for i in lboards for j in list(i) if self.nextInx not in i]
-        numIter = len(lboards)    
-        while numIter < self.batchSize:
-            if self.randomOrder:
-                random.shuffle(order)
-            numIter += 1
-            temp = self.randomConditionalBoard(order)
-            boards += temp
-            lboards.append(set(temp))
-        self.lastTurnBoards = lboards
+        hist = np.zeros(self.dim * self.dim)
+        if not self.resampleParticles(order, hist):
+            _aggregateBoards(self.particles, self.weights / self.weights.sum(), hist)
         
-        self.aggDict = dict(Counter(boards).most_common())
+        self.aggMatrix = hist.reshape(self.dim, self.dim)
         
-        self.numIter = numIter
+        self.numIter = np.count_nonzero(self.weights) # boards that still count towards aggMatrix
         if self.printTime:
             print(time()-t)
 
@@ -245,14 +661,18 @@ class BattleshipPlayer(Battleship):
         """
 
         self.buildAggBoard()
-        matrix = np.zeros((self.dim,self.dim))
-        for location in self.aggDict.keys():
-            matrix[location[0], location[1]] = self.aggDict[location]
-        matrix = matrix / self.numIter
+        matrix = self.aggMatrix
         if graph:
             self._print(matrix,notext)
         print(self.numIter, "Iterations")
-        self.maxInx = ((np.argmax(matrix) % self.dim), int(np.floor((np.argmax(matrix) / self.dim))))
+        self.maxInx = self.bestGuess()
+        
+    def bestGuess(self):
+        """
+        The (i,j) cell with the highest probability in self.aggMatrix that has not been guessed yet
+        """
+        matrix = np.where(self.maskToMatrix(self.hitsMask | self.missesMask), -1, self.aggMatrix)
+        return divmod(int(np.argmax(matrix)), self.dim)
         
     def _print(self, matrix, notext):
         """
@@ -279,7 +699,7 @@ class BattleshipPlayer(Battleship):
         Function to guess while playing the game 'by hand'
         """
         self.nextInx = guessInx
-        if guessInx in self.board:
+        if self.cellInMask(guessInx, self.board):
             print("HIT")
             self.hits.add(guessInx)
         else:
@@ -287,12 +707,20 @@ class BattleshipPlayer(Battleship):
             self.misses.add(guessInx)
  
     def refreshGame(self):
+        """
+        Start a new game, resetting the per-game state in place (aliveOrient, sunkDict, the
+        conditional orientation counts, and the particles) rather than reallocating it
+        """
         self.board = self.randomBoard()
-        self.hits, self.misses, self.hitsSunk = set(), set(), set()
-        self.sunkDict = dict(zip(self.names,[0 for i in self.ships]))
-        self.possibleShipsDictCond = self.possibleShipsDict.copy()
-        self.possibleShipsNumDictCond = self.possibleShipsNumDict.copy()
-        self.lastTurnBoards = list()
+        self.hits.clear()
+        self.misses.clear()
+        self.hitsSunk[:] = 0
+        self.aliveOrient[:] = True
+        for name in self.names:
+            self.sunkDict[name] = 0
+            self.possibleShipsNumDictCond[name] = self.possibleShipsNumDict[name]
+        self.particles = np.zeros((0, self.numWords), dtype=np.uint64)
+        self.weights = np.zeros(0)
         self.nextInx = (-1,-1)
             
 class BattleshipAutoplay(BattleshipPlayer):
@@ -322,11 +750,8 @@ class BattleshipAutoplay(BattleshipPlayer):
                     self.refreshGame()
                 return n
             self.buildAggBoard()
-            for i in self.hits:
-                del self.aggDict[i]
-            
-            self.nextInx = max(self.aggDict, key=self.aggDict.get)
-            if self.nextInx in self.board:
+            self.nextInx = self.bestGuess()
+            if self.cellInMask(self.nextInx, self.board):
                 self.hits.add(self.nextInx)
             else:
                 self.misses.add(self.nextInx)